@@ -5,43 +5,61 @@
 
 
 import gzip
-import json
+import io
+import multiprocessing
+import os
 import re
 import shutil
+import signal
+import subprocess
 import sys
 from argparse import ArgumentParser
-from dataclasses import asdict, dataclass
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, fields
 from ftplib import FTP
-from itertools import chain
-from logging import DEBUG, basicConfig, getLogger
+from logging import DEBUG, Handler, LogRecord, basicConfig, getLogger
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
-from typing import Callable, Iterable, List, Optional, Tuple, TypeVar
+from typing import IO, Callable, Iterable, Iterator, Optional, cast
 
+import numpy as np
+import orjson
+import pandas as pd
 from astropy.time import Time
+from numpy.polynomial.polynomial import polyval
 
 # PROCESS SWITCH
 
 ENABLE_HP = True
 ENABLE_T2 = False
 
+# LOG FILE
+
+LOG_FILE = "convert.log"
+
 # FILES AND ENDPOINTS
 
 SRC_HOST = "dbc.nao.ac.jp"
 SRC_PATH_HP = "/DBC/NASAADC/catalogs/1/1239/"
 SRC_PATH_T2 = "/DBC/NASAADC/catalogs/1/1259/"
+# number of concurrent connections for downloading
+FTP_MAX_CONNECTIONS = 4
 
 CACHE_BASE = Path(__file__).parent.parent.joinpath(".cache")
 CACHE_STARS_HP = CACHE_BASE / "hipparcos"
 CACHE_STARS_T2 = CACHE_BASE / "tycho2"
 
-FILES_HP = "hip_main.dat.gz"
-FILES_T2 = "tyc2_[0-9]{2}.dat.gz"
+FILES_HP = r"hip_main\.dat\.gz"
+FILES_T2 = r"tyc2_[0-9]{2}\.dat\.gz"
 
 
 OUT_RANGES: list[float] = [1.5, 3.0, 6.0]
 OUT_HP_FORMAT = "dat_hp_{}.json"
+OUT_HP_BIN_FORMAT = "dat_hp_{}.bin"
 OUT_HP_METADATA = "dat_hp_meta.json"
 OUT_T2_FORMAT = "dat_t2_{}.json"
+OUT_T2_BIN_FORMAT = "dat_t2_{}.bin"
 OUT_T2_METADATA = "dat_t2_meta.json"
 
 # NORMALIZATION OPTION
@@ -59,26 +77,35 @@ NORM_COLORS_LOCAL = True  # brighter stars
 # - http://ysmr-ry.hatenablog.com/entry/2017/08/06/104857
 # - http://uenosato.net/hr_diagram/doc/draw_hr_diagram.pdf
 # - http://www.cc.kyoto-su.ac.jp/~kano/pdf/study/student/2020SanoPaper.pdf
-BV_T_COEF = [3.939654, -0.395361, 0.2082113, -0.0604097]
+BV_T_COEF = np.array([3.939654, -0.395361, 0.2082113, -0.0604097])
 
 # T(K) to xy
 # - https://en.wikipedia.org/wiki/Planckian_locus
-T_CX_COEF_TABLE = [
-    (1667.0, +4000.0, [+0.179910, +0.8776956, -0.2343589, -0.2661239]),
-    (4000.0, 25000.0, [+0.240390, +0.2226347, +2.1070379, -3.0258469]),
-]
-T_CY_COEF_TABLE = [
-    (1667.0, +2222.0, [-0.20219683, +2.18555832, -1.34811020, -1.1063814]),
-    (2222.0, +4000.0, [-0.16748867, +2.09137015, -1.37418593, -0.9549476]),
-    (4000.0, 25000.0, [-0.37001483, +3.75112997, -5.87338670, +3.0817580]),
-]
+# coefficients for each range, [BOUNDS[i], BOUNDS[i + 1])
+T_CX_BOUNDS = np.array([1667.0, 4000.0, 25000.0])
+T_CX_COEFS = np.array(
+    [
+        [+0.179910, +0.8776956, -0.2343589, -0.2661239],
+        [+0.240390, +0.2226347, +2.1070379, -3.0258469],
+    ]
+)
+T_CY_BOUNDS = np.array([1667.0, 2222.0, 4000.0, 25000.0])
+T_CY_COEFS = np.array(
+    [
+        [-0.20219683, +2.18555832, -1.34811020, -1.1063814],
+        [-0.16748867, +2.09137015, -1.37418593, -0.9549476],
+        [-0.37001483, +3.75112997, -5.87338670, +3.0817580],
+    ]
+)
 # XYZ to sRGB
 # https://kazmus.hatenablog.jp/entry/2018/04/29/193659
 # http://www.motorwarp.com/koizumi/srgb.html
-XYZ_SRGB_COEF = (
-    [+3.240970, -1.537383, -0.498611],
-    [-0.969244, +1.875968, +0.041555],
-    [+0.055630, -0.203977, +1.056972],
+XYZ_SRGB_COEF = np.array(
+    [
+        [+3.240970, -1.537383, -0.498611],
+        [-0.969244, +1.875968, +0.041555],
+        [+0.055630, -0.203977, +1.056972],
+    ]
 )
 
 # Telestial Time of J1991.25, JD2448349.0625
@@ -90,43 +117,83 @@ STAR_DEFAULT_COLOR = (0.9, 0.9, 0.9)
 
 COLOR_SIG_DIGITS = 4
 
+# version of the output format
+# - 1: colors of stars are written as rgb for each star
+# - 2: colors are deduplicated into the palette in metadata, stars have its index
+METADATA_VERSION = 2
+
+# buffer size for reading/writing files
+IO_BUFFER_SIZE = 256 * 1024
+
+# number of stars converted to json at once.
+# a chunk of columns (7 doubles and a color index per star) fits in L2 cache.
+JSON_CHUNK_SIZE = 2048
+# columns of StarsTable written to json, in the order of _to_json_rows
+JSON_STAR_COLUMNS = ("hip_id", "ra", "dec", "parallax", "pm_ra", "pm_dec", "v_mag")
+
+# b-v range of the precomputed color table.
+# table is sampled at 0.001 steps, same precision as the B-V in the catalogue.
+BV_LUT_RANGE = (-1.0, 3.0)
+BV_LUT_SIZE = 4001
+
+# record layout of the binary output, little endian, without padding.
+# it's written into the metadata as `records`, readers should follow it.
+# ra and dec are kept in double precision to hold the precision of the catalogue.
+BIN_STAR_DTYPE = np.dtype(
+    [
+        ("hip_id", "<i4"),
+        ("ra", "<f8"),
+        ("dec", "<f8"),
+        ("parallax", "<f4"),
+        ("pm_ra", "<f4"),
+        ("pm_dec", "<f4"),
+        ("v_mag", "<f4"),
+        ("c", "<u2"),
+    ]
+)
+
 #
 # CORE DATA STRUCTURE
 # ------------------------------------------------------------------------------
 
 
 @dataclass
-class RawStarInfo:
+class StarsTable:
     # hipparcos number of the star
-    hip_id: int
+    hip_id: np.ndarray
     # right ascension (ICRS), deg
-    ra: float
+    ra: np.ndarray
     # declination (ICRS), deg
-    dec: float
+    dec: np.ndarray
     # parallax, milliarcseconds
-    parallax: float
+    parallax: np.ndarray
     # proper motion of ra, milliarcseconds/year
-    pm_ra: float
+    pm_ra: np.ndarray
     # proper motion of dec, milliarcseconds/year
-    pm_dec: float
+    pm_dec: np.ndarray
     # magnitude of Johnson V
-    v_mag: float
-    # Johnson BV color
-    bv: Optional[float]
-
-
-@dataclass
-class OutputStarInfo:
-    # star number
-    n: int
-    # position (right ascention, declination, and parallax)
-    p: tuple[float, float, float]
-    # proper motion, ra and dec, milliarcseconds/year
-    m: tuple[float, float]
-    # visual band magnitude
-    v: float
-    # star color, linear rgb [0..1]
-    c: tuple[float, float, float]
+    v_mag: np.ndarray
+    # Johnson BV color, NaN if not specified
+    bv: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.hip_id)
+
+    def take(self, indices) -> "StarsTable":
+        # indices may be an index array, a boolean mask, or a slice.
+        return StarsTable(*(getattr(self, f.name)[indices] for f in fields(self)))
+
+    @staticmethod
+    def concat(tables: Iterable["StarsTable"]) -> "StarsTable":
+        tables = list(tables)
+        if not tables:
+            return StarsTable(*(np.empty(0) for _ in fields(StarsTable)))
+        return StarsTable(
+            *(
+                np.concatenate([getattr(t, f.name) for t in tables])
+                for f in fields(StarsTable)
+            )
+        )
 
 
 @dataclass
@@ -136,7 +203,14 @@ class StarsMetadata:
     # stars files
     files: list[tuple[float, float, str]]
     # base time of proper motions of stars, unix epoch
-    pm_epoch: int
+    pm_epoch: float
+    # star colors, linear rgb [0..1]; stars refer them by the index
+    palette: list[tuple[float, float, float]]
+    # version of the format, see METADATA_VERSION
+    version: int = METADATA_VERSION
+    # record layout of the binary stars files as (name, type) of numpy dtype,
+    # None if the stars files are json.
+    records: Optional[list[tuple[str, str]]] = None
 
 
 #
@@ -157,6 +231,11 @@ def _main():
         help="output directory",
         default=str(Path(__file__).parent.joinpath("output")),
     )
+    parser.add_argument(
+        "--binary",
+        action="store_true",
+        help="write stars as packed binary records instead of json.",
+    )
     args = parser.parse_args()
 
     # parse output directory
@@ -167,10 +246,10 @@ def _main():
         )
         sys.exit(-1)
 
-    _stars_main(args.nocache, out_dir)
+    _stars_main(args.nocache, out_dir, args.binary)
 
 
-def _stars_main(nocache: bool, output_dir: Path):
+def _stars_main(nocache: bool, output_dir: Path, binary: bool = False):
     # download section
     if ENABLE_HP and (nocache or not CACHE_STARS_HP.is_dir()):
         # download hipparcos star data
@@ -187,18 +266,21 @@ def _stars_main(nocache: bool, output_dir: Path):
     # process section
     if ENABLE_HP:
         stars = _proc_star_files(
-            _proc_line_hipparcos,
+            _proc_file_hipparcos,
             CACHE_STARS_HP.glob("*"),
         )
-        out_stars = filter(None, map(_convert_star_info, stars))
+        stars, colors = _convert_star_colors(stars)
         _export_to_json_with_metadata(
             output_dir,
-            OUT_HP_FORMAT,
+            OUT_HP_BIN_FORMAT if binary else OUT_HP_FORMAT,
             OUT_HP_METADATA,
-            J1991_25.unix,
-            out_stars,
+            float(J1991_25.unix),
+            stars,
+            colors,
             100,
             4,
+            _write_stars_to_bin if binary else _write_stars_to_json,
+            BIN_STAR_DTYPE if binary else None,
         )
 
 
@@ -223,244 +305,477 @@ def _download_ftp(
         dest.mkdir(parents=True)
     # connect as anonymous
     print(f"connect: ftp://{host}")
-    ftp_client = FTP(host)
-    ftp_client.login()
-    # change to target dir
-    print(f"working dir: {path}")
-    ftp_client.cwd(path)
-    # iterate directory entries
-    for filename in ftp_client.nlst():
-        if not re.match(pattern, filename):
-            # if not filename.endswith(pattern):
-            # suffix of the file does not match
-            continue
-        print(f"download: {filename}")
-        _download_ftp_file(ftp_client, filename, dest)
-
-
-def _download_ftp_file(ftp_client: FTP, filename: str, dest: Path):
-    with dest.joinpath(filename).open("wb") as f:
+    with FTP(host) as ftp_client:
+        ftp_client.login()
+        # change to target dir
+        print(f"working dir: {path}")
+        ftp_client.cwd(path)
+        regex = re.compile(pattern)
+        # pick the files whose name matches the pattern
+        filenames = [fn for fn in ftp_client.nlst() if regex.fullmatch(fn)]
+    # download files in parallel, with a connection for each file
+    with ThreadPoolExecutor(max_workers=FTP_MAX_CONNECTIONS) as executor:
+        list(
+            executor.map(
+                lambda filename: _download_ftp_file(host, path, filename, dest),
+                filenames,
+            )
+        )
+
+
+def _download_ftp_file(host: str, path: str, filename: str, dest: Path):
+    print(f"download: {filename}")
+    with FTP(host) as ftp_client, dest.joinpath(filename).open("wb") as f:
+        ftp_client.login()
+        ftp_client.cwd(path)
         ftp_client.retrbinary(f"RETR {filename}", f.write)
 
 
-def _proc_line_hipparcos(line: str) -> Optional[RawStarInfo]:
-    splitted = [s.strip() for s in line.split("|")]
-    try:
-        return RawStarInfo(
-            hip_id=int(splitted[1]),
-            ra=_read_ra(splitted[3]) or 0,
-            dec=_read_dec(splitted[4]) or 0,
-            parallax=_read_nullable_float(splitted[11]) or 0,
-            pm_ra=_read_nullable_float(splitted[12]) or 0,
-            pm_dec=_read_nullable_float(splitted[13]) or 0,
-            v_mag=float(splitted[5]),
-            bv=(None if splitted[37] == "" else float(splitted[37])),
-        )
-    except ValueError as e:
-        getLogger(__name__).debug(
-            f"parse error: star#{splitted[1]} - {line}",
-            exc_info=e,
+# columns of the hipparcos main catalogue used in this script
+HP_COLUMNS = {
+    "hip_id": 1,
+    "ra": 3,
+    "dec": 4,
+    "v_mag": 5,
+    "parallax": 11,
+    "pm_ra": 12,
+    "pm_dec": 13,
+    "bv": 37,
+}
+# fixed-width layouts of sexagesimal columns.
+# +: sign, D: hours/degrees, M: minutes, S: seconds, F: fraction of seconds
+HP_RA_LAYOUT = "DD MM SS.FF"
+HP_DEC_LAYOUT = "+DD MM SS.F"
+
+
+def _proc_file_hipparcos(file: Path) -> StarsTable:
+    with _open_maybe_gz(file, "rt") as f:
+        df = pd.read_csv(
+            f,
+            sep="|",
+            header=None,
+            usecols=list(HP_COLUMNS.values()),
+            dtype=str,
+            keep_default_na=False,
+            engine="c",
         )
+    raw = {k: df[n] for (k, n) in HP_COLUMNS.items()}
+    blank = {k: c.str.strip() == "" for (k, c) in raw.items()}
+    cols = {
+        k: pd.to_numeric(c, errors="coerce")
+        for (k, c) in raw.items()
+        if k not in ("ra", "dec")
+    }
+    # hip_id should be integral, reject values like "1.5"
+    cols["hip_id"] = cols["hip_id"].where(cols["hip_id"] % 1 == 0)
+    cols["ra"] = _read_sexagesimal(raw["ra"], HP_RA_LAYOUT) / (3600 / 15)
+    cols["dec"] = _read_sexagesimal(raw["dec"], HP_DEC_LAYOUT) / 3600
+    # hip_id and v_mag are mandatory, other values could be omitted
+    invalid = blank["hip_id"] | blank["v_mag"]
+    for k, c in cols.items():
+        invalid |= c.isna() & ~blank[k]
+    for i in np.flatnonzero(invalid.to_numpy()).tolist():
         outs = ", ".join(
-            map(lambda n: f"{n}: {splitted[n]}", [1, 8, 9, 11, 12, 13, 5, 37])
+            f"{n}: {str(df[n].iat[i]).strip()}" for n in HP_COLUMNS.values()
         )
         getLogger(__name__).warning(
-            f"skipped: #{splitted[1]} -- invalid data.{outs}",
+            f"skipped: #{str(raw['hip_id'].iat[i]).strip()} -- invalid data.{outs}",
         )
-        return None
-
-
-def _proc_line_tycho2(line: str) -> Optional[RawStarInfo]:
-    pass
-
-
-def _read_ra(item: str) -> Optional[float]:
-    hms = _read_ra_dec_item(item)
-    if hms is None:
-        return None
-    sign = -1 if item.strip()[0] == "-" else +1
-    h, m, s = hms
-    return sign * ((abs(h) * 3600) + (m * 60) + s) / (3600 / 15)
 
+    valid = ~invalid.to_numpy()
+    return StarsTable(
+        hip_id=cols["hip_id"].to_numpy()[valid].astype(np.int32),
+        ra=cols["ra"].fillna(0).to_numpy()[valid],
+        dec=cols["dec"].fillna(0).to_numpy()[valid],
+        parallax=cols["parallax"].fillna(0).to_numpy()[valid],
+        pm_ra=cols["pm_ra"].fillna(0).to_numpy()[valid],
+        pm_dec=cols["pm_dec"].fillna(0).to_numpy()[valid],
+        v_mag=cols["v_mag"].to_numpy()[valid],
+        bv=cols["bv"].to_numpy()[valid],
+    )
 
-def _read_dec(item: str) -> Optional[float]:
-    dms = _read_ra_dec_item(item)
-    if dms is None:
-        return None
-    sign = -1 if item.strip()[0] == "-" else +1
-    d, m, s = dms
-    return sign * (((abs(d) * 3600) + (m * 60) + s) / 3600)
 
+def _proc_file_tycho2(file: Path) -> StarsTable:
+    # not supported yet, yields no stars.
+    return StarsTable.concat([])
+
+
+def _read_sexagesimal(items: pd.Series, layout: str) -> pd.Series:
+    # read fixed-width items as (signed) seconds, NaN if malformed.
+    # items are handled as a matrix of code points instead of parsing each string.
+    n = len(layout)
+    chars = items.to_numpy(dtype=str).astype(f"U{n + 1}").view(np.uint32)
+    codes = chars.reshape(len(items), n + 1).astype(np.int64)
+    digits = codes[:, :n] - ord("0")
+    # check lengths (the last code is zero if shorter), digits, and separators
+    valid = (codes[:, n - 1] != 0) & (codes[:, n] == 0)
+    for i, c in enumerate(layout):
+        if c in "DMSF":
+            valid &= (0 <= digits[:, i]) & (digits[:, i] <= 9)
+        elif c == "+":
+            valid &= (codes[:, i] == ord("+")) | (codes[:, i] == ord("-"))
+        else:
+            valid &= codes[:, i] == ord(c)
+
+    def read_digits(kinds: str) -> np.ndarray:
+        idx = [i for (i, c) in enumerate(layout) if c in kinds]
+        return digits[:, idx] @ (10 ** np.arange(len(idx) - 1, -1, -1))
+
+    # fraction is divided at last, to get the same value as parsing "ss.ff"
+    f_scale = 10 ** layout.count("F")
+    seconds = (
+        (read_digits("D") * 3600)
+        + (read_digits("M") * 60)
+        + (read_digits("SF") / f_scale)
+    )
+    if "+" in layout:
+        seconds *= np.where(codes[:, layout.index("+")] == ord("-"), -1, +1)
+    return pd.Series(np.where(valid, seconds, np.nan), index=items.index)
 
-def _read_ra_dec_item(item: str) -> Optional[Tuple[int, int, float]]:
-    item = item.strip()
-    if item == "":
-        return None
-    a = item.split(" ")
-    return int(a[0]), int(a[1]), float(a[2])
 
+def _proc_star_files(
+    file_handler: Callable[[Path], StarsTable], files: Iterable[Path]
+) -> StarsTable:
+    # each file is independent, so parse them in parallel.
+    # file_handler should be a module-level function to be pickled.
+    files = list(files)
+    # workers send their log records back, handled by the logging config of here.
+    queue: multiprocessing.Queue[LogRecord] = multiprocessing.Queue()
+    listener = QueueListener(queue, _RelayHandler())
+    listener.start()
+    try:
+        with ProcessPoolExecutor(
+            max_workers=max(1, min(len(files), os.cpu_count() or 1)),
+            initializer=_setup_worker_logging,
+            initargs=(queue, getLogger().getEffectiveLevel()),
+        ) as executor:
+            return StarsTable.concat(executor.map(file_handler, files))
+    finally:
+        listener.stop()
+
+
+def _batch_slices(
+    num: int, s_num_init: int, s_num_factor: float
+) -> Iterator[tuple[int, int]]:
+    # each batch contains (s_num + 1) items at most, s_num grows for each batch.
+    start = 0
+    s_num = float(s_num_init)
+    while start < num:
+        stop = min(start + int(s_num) + 1, num)
+        yield start, stop
+        start = stop
+        s_num *= s_num_factor
 
-def _read_nullable_float(item: str) -> Optional[float]:
-    item = item.strip()
-    return None if item == "" else float(item)
 
+def _write_stars_to_json(
+    file: Path, stars: StarsTable, color_ids: np.ndarray
+) -> tuple[float, float, str]:
+    # convert and write stars chunk by chunk,
+    # not to hold whole json string in memory.
+    columns = [getattr(stars, name) for name in JSON_STAR_COLUMNS]
+    with _open_maybe_gz(file, "wb") as f:
+        f.write(b"[")
+        for start in range(0, len(stars), JSON_CHUNK_SIZE):
+            stop = start + JSON_CHUNK_SIZE
+            if start > 0:
+                f.write(b",")
+            rows = _to_json_rows(
+                [c[start:stop] for c in columns], color_ids[start:stop]
+            )
+            # strip brackets to concatenate chunks into an array
+            f.write(orjson.dumps(rows)[1:-1])
+        f.write(b"]")
+    return float(stars.v_mag[0]), float(stars.v_mag[-1]), file.name
+
+
+def _to_json_rows(columns: list[np.ndarray], color_ids: np.ndarray) -> list[dict]:
+    # columns are given in the order of JSON_STAR_COLUMNS
+    return [
+        {"n": n, "p": [ra, dec, plx], "m": [pm_ra, pm_dec], "v": v, "c": c}
+        for (n, ra, dec, plx, pm_ra, pm_dec, v, c) in zip(
+            *(c.tolist() for c in columns),
+            color_ids.tolist(),
+        )
+    ]
 
-def _proc_star_files(
-    line_handler: Callable[[str], Optional[RawStarInfo]], files: Iterable[Path]
-) -> Iterable[RawStarInfo]:
-    def proc_single(file: Path) -> Iterable[RawStarInfo]:
-        mode = "rt"
-        is_gzip = file.suffix == ".gz"
-        with (gzip.open(str(file), mode) if is_gzip else file.open(mode)) as f:
-            return [s for s in map(line_handler, f) if s is not None]
 
-    return chain.from_iterable(map(proc_single, files))
+def _write_stars_to_bin(
+    file: Path, stars: StarsTable, color_ids: np.ndarray
+) -> tuple[float, float, str]:
+    c_max = np.iinfo(BIN_STAR_DTYPE["c"]).max
+    if len(color_ids) > 0 and color_ids.max() > c_max:
+        raise ValueError(f"color index exceeds {c_max}, too many star colors.")
+    records = np.empty(len(stars), dtype=BIN_STAR_DTYPE)
+    for name in ("hip_id", "ra", "dec", "parallax", "pm_ra", "pm_dec", "v_mag"):
+        records[name] = getattr(stars, name)
+    records["c"] = color_ids
+    with _open_maybe_gz(file, "wb") as f:
+        f.write(records.tobytes())
+    return float(stars.v_mag[0]), float(stars.v_mag[-1]), file.name
 
 
 def _export_to_json_with_metadata(
     out_dir: Path,
     fn_format: str,
     fn_metadata: str,
-    pm_epoch: int,
-    stars: Iterable[OutputStarInfo],
+    pm_epoch: float,
+    stars: StarsTable,
+    colors: np.ndarray,
     s_num_init: int,
     s_num_factor: float,
+    stars_writer: Callable[
+        [Path, StarsTable, np.ndarray], tuple[float, float, str]
+    ] = _write_stars_to_json,
+    record_dtype: Optional[np.dtype] = None,
 ):
-    sorted_stars = sorted(stars, key=lambda s: s.v)
+    order = np.argsort(stars.v_mag, kind="stable")
+    stars = stars.take(order)
+    colors = colors[order]
     if NORM_COLORS_GLOBAL:
         # normalize star colors
-        sorted_stars = _normalize_star_colors(sorted_stars)
-    num_batch = 0
-    stars_batched: list[OutputStarInfo] = []
-    s_num = float(s_num_init)
-    export_list: list[tuple[float, float, str]] = []
-    for star in sorted_stars:
-        stars_batched.append(star)
-        if len(stars_batched) > s_num:
-            export_list.append(
-                _write_stars_to_json(
-                    out_dir / fn_format.format(num_batch), stars_batched
-                )
-            )
-            stars_batched.clear()
-            num_batch += 1
-            s_num *= s_num_factor
-    # final export
-    if len(stars_batched) > 0:
-        export_list.append(
-            _write_stars_to_json(out_dir / fn_format.format(num_batch), stars_batched)
+        colors = _normalize_star_colors(colors)
+    # crop significant digits to compress data size
+    np.round(colors, COLOR_SIG_DIGITS, out=colors)
+    # most stars share the same color, write colors as indices of the palette
+    palette, color_ids = np.unique(colors, axis=0, return_inverse=True)
+    color_ids = color_ids.reshape(-1)
+    export_list = [
+        stars_writer(
+            out_dir / fn_format.format(num_batch),
+            stars.take(slice(start, stop)),
+            color_ids[start:stop],
         )
+        for (num_batch, (start, stop)) in enumerate(
+            _batch_slices(len(stars), s_num_init, s_num_factor)
+        )
+    ]
     # write metadata
-    min_v, max_v = sorted_stars[0].v, sorted_stars[-1].v
-    metadata = StarsMetadata((min_v, max_v), export_list, pm_epoch)
+    min_v, max_v = float(stars.v_mag[0]), float(stars.v_mag[-1])
+    records: Optional[list[tuple[str, str]]] = None
+    if record_dtype is not None:
+        records = [(n, record_dtype[n].str) for n in record_dtype.names or ()]
+    metadata = StarsMetadata(
+        (min_v, max_v),
+        export_list,
+        pm_epoch,
+        [tuple(c) for c in palette.tolist()],
+        METADATA_VERSION,
+        records,
+    )
     _write_metadata_to_json(out_dir / fn_metadata, metadata)
 
 
-def _write_stars_to_json(
-    file: Path, stars: list[OutputStarInfo]
-) -> tuple[float, float, str]:
-    mode = "wt"
-    is_gzip = file.suffix == ".gz"
-    with (gzip.open(str(file), mode) if is_gzip else file.open(mode)) as f:
-        json.dump([asdict(s) for s in stars], f)  # type: ignore
-    return stars[0].v, stars[-1].v, file.name
-
-
 def _write_metadata_to_json(file: Path, metadata: StarsMetadata):
-    mode = "wt"
-    is_gzip = file.suffix == ".gz"
-    with (gzip.open(str(file), mode) if is_gzip else file.open(mode)) as f:
-        json.dump(asdict(metadata), f)  # type: ignore
-
-
-def _convert_star_info(star: RawStarInfo) -> Optional[OutputStarInfo]:
-    try:
-        rgb = _convert_bv_to_linear_rgb(star.bv)
-        return OutputStarInfo(
-            star.hip_id,
-            (star.ra, star.dec, star.parallax),
-            (star.pm_ra, star.pm_dec),
-            star.v_mag,
-            rgb,
+    with _open_maybe_gz(file, "wb") as f:
+        f.write(orjson.dumps(metadata))
+
+
+@contextmanager
+def _open_maybe_gz(file: Path, mode: str) -> Iterator[IO]:
+    if file.suffix != ".gz":
+        with file.open(mode, buffering=IO_BUFFER_SIZE) as f:
+            yield f
+        return
+    is_read = "r" in mode
+    is_text = "t" in mode
+    if shutil.which("gzip") is None:
+        # gzip command is not available, fallback to the gzip module
+        gz = gzip.GzipFile(str(file), "rb" if is_read else "wb")
+        with (
+            io.BufferedReader(gz, IO_BUFFER_SIZE)  # type: ignore
+            if is_read
+            else io.BufferedWriter(gz, IO_BUFFER_SIZE)  # type: ignore
+        ) as buffered:
+            # close the text wrapper too, or its pending writes are lost.
+            with (
+                io.TextIOWrapper(buffered, encoding="ascii") if is_text else buffered
+            ) as f:
+                yield f
+        return
+    # (de)compress by the external process, runs concurrently with this process.
+    if is_read:
+        proc = subprocess.Popen(
+            ["gzip", "-dc", str(file)],
+            stdout=subprocess.PIPE,
+            bufsize=IO_BUFFER_SIZE,
+        )
+        assert proc.stdout is not None
+        stream: IO[bytes] = proc.stdout
+    else:
+        with file.open("wb") as out:
+            proc = subprocess.Popen(
+                ["gzip", "-c"],
+                stdin=subprocess.PIPE,
+                stdout=out,
+                bufsize=IO_BUFFER_SIZE,
+            )
+        assert proc.stdin is not None
+        stream = proc.stdin
+    with proc:
+        # bufsize is given, so the stream is buffered and can be peeked.
+        if is_read and not cast(io.BufferedReader, stream).peek(1):
+            # nothing to read, gzip may have failed before writing anything.
+            error = _wait_gzip_proc(proc, is_read)
+            if error is not None:
+                raise error
+        try:
+            wrapped: IO = (
+                io.TextIOWrapper(stream, encoding="ascii") if is_text else stream
+            )
+            with wrapped as f:
+                yield f
+        except Exception as e:
+            # a broken stream may fail the caller, show the gzip error as the cause.
+            error = _wait_gzip_proc(proc, is_read)
+            if error is None:
+                raise
+            raise e from error
+        error = _wait_gzip_proc(proc, is_read)
+        if error is not None:
+            raise error
+
+
+def _wait_gzip_proc(
+    proc: "subprocess.Popen[bytes]", is_read: bool
+) -> Optional[subprocess.CalledProcessError]:
+    # close our end of the pipe and wait for gzip, returns the error if it failed.
+    # a reader may stop before EOF, then gzip is killed by SIGPIPE; it's not an error.
+    pipe = proc.stdout if is_read else proc.stdin
+    if pipe is not None:
+        pipe.close()
+    returncode = proc.wait()
+    if returncode == 0 or (is_read and returncode == -signal.SIGPIPE):
+        return None
+    return subprocess.CalledProcessError(returncode, proc.args)
+
+
+def _convert_star_colors(stars: StarsTable) -> tuple[StarsTable, np.ndarray]:
+    # returns the stars that have a valid color, and their colors.
+    colors = _convert_bv_to_linear_rgb(stars.bv)
+    valid = np.isfinite(colors).all(axis=1)
+    if not valid.all():
+        skipped = ", ".join(
+            f"#{hip_id} ({bv})"
+            for (hip_id, bv) in zip(
+                stars.hip_id[~valid].tolist(), stars.bv[~valid].tolist()
+            )
         )
-    except ValueError as e:
-        getLogger(__name__).debug(f"conversion error: {star.hip_id}", exc_info=e)
         getLogger(__name__).warning(
-            f"skipped: #{star.hip_id} -- color out of range: {star.bv}."
+            f"skipped: {np.count_nonzero(~valid)} stars -- color out of range: "
+            f"{skipped}."
         )
-        return None
+    return stars.take(valid), colors[valid]
+
 
+def _convert_bv_to_linear_rgb(bv: np.ndarray) -> np.ndarray:
+    # look up the precomputed table instead of evaluating polynomials for each star.
+    bv = np.asarray(bv, dtype=np.float64)
+    is_na = np.isnan(bv)
+    pos = (np.where(is_na, BV_LUT_RANGE[0], bv) - BV_LUT_RANGE[0]) / _BV_LUT_STEP
+    # b-v values out of the table are out of temperature range as well,
+    # so it's safe to clamp them into the edge (NaN) rows.
+    idx = np.clip(np.rint(pos), 0, BV_LUT_SIZE - 1).astype(np.intp)
+    rgb = _BV_LUT[idx]
+    # if b-v value is not present, fill as just 'white'
+    rgb[is_na] = STAR_DEFAULT_COLOR
+    return rgb
 
-def _convert_bv_to_linear_rgb(bv: Optional[float]) -> tuple[float, float, float]:
-    # if b-v value is not present, return as just 'white'
-    if bv is None:
-        return STAR_DEFAULT_COLOR
+
+def _convert_bv_to_linear_rgb_batch(bv: np.ndarray) -> np.ndarray:
+    # b-v values are given as an array (NaN for unspecified), returns (N, 3) array.
+    # colors of the stars that temperature is out of range are filled with NaN.
+    bv = np.asarray(bv, dtype=np.float64)
 
     # bv -> t
-    log_10_t = sum(c * (bv ** n) for (n, c) in enumerate(BV_T_COEF))
+    log_10_t = polyval(bv, BV_T_COEF)
     t = 10.0 ** log_10_t
     # alt_t = 4600 * ((1.0 / (0.92 * bv + 1.7)) + (1 / (0.92 * bv + 0.62)))
 
     # t -> xy
-    cx_coef = _select_coef_table(t, T_CX_COEF_TABLE)
-    cy_coef = _select_coef_table(t, T_CY_COEF_TABLE)
-    if cx_coef is None or cy_coef is None:
-        # unsupported range
-        raise ValueError(f"temperature `{t}` is out of range, bv: {bv}")
-
-    cx = sum(c * (10 ** (3 * n)) / (t ** n) for (n, c) in enumerate(cx_coef))
-    cy = sum(c * (cx ** n) for (n, c) in enumerate(cy_coef))
+    cx_coef = _select_coef_rows(t, T_CX_BOUNDS, _T_CX_COEFS_PADDED)
+    cy_coef = _select_coef_rows(t, T_CY_BOUNDS, _T_CY_COEFS_PADDED)
+    cx = polyval(1e3 / t, cx_coef.T, tensor=False)
+    cy = polyval(cx, cy_coef.T, tensor=False)
 
     # xy -> XYZ
-    y = 1.0
+    y = np.ones_like(cy)
     x = (y / cy) * cx
     z = (y / cy) * (1 - cx - cy)
 
     # XYZ -> linear RGB
-    xyz = [x, y, z]
-    r_l = sum(n * c for n, c in zip(xyz, XYZ_SRGB_COEF[0]))
-    g_l = sum(n * c for n, c in zip(xyz, XYZ_SRGB_COEF[1]))
-    b_l = sum(n * c for n, c in zip(xyz, XYZ_SRGB_COEF[2]))
+    xyz = np.stack([x, y, z], axis=1)
+    rgb = xyz @ XYZ_SRGB_COEF.T
 
     # linear RGB -> normalized RGB
     if NORM_COLORS_LOCAL:
-        rgb_max = max(r_l, g_l, b_l)
-        r_l = r_l / rgb_max
-        g_l = g_l / rgb_max
-        b_l = b_l / rgb_max
+        rgb /= rgb.max(axis=1, keepdims=True)
 
-    # crop significant digits to compress data size
-    r_c = round(r_l, COLOR_SIG_DIGITS)
-    g_c = round(g_l, COLOR_SIG_DIGITS)
-    b_c = round(b_l, COLOR_SIG_DIGITS)
+    # if b-v value is not present, fill as just 'white'
+    rgb[np.isnan(bv)] = STAR_DEFAULT_COLOR
 
     # WebGL accepts the Linear RGB color space.
-    return r_c, g_c, b_c
+    return rgb
+
+
+def _normalize_star_colors(colors: np.ndarray) -> np.ndarray:
+    # apply for all star colors, in place
+    rgb_max = float(colors.max(initial=0.0))
+    if rgb_max > 0:
+        colors /= rgb_max
+    return colors
+
+
+def _select_coef_rows(
+    values: np.ndarray,
+    bounds: np.ndarray,
+    coefs: np.ndarray,
+) -> np.ndarray:
+    # index of the range for each value, without branches.
+    # coefs must end with the NaN sentinel row, see _pad_nan_row.
+    # values out of range (including NaN) get the sentinel row.
+    sentinel = len(coefs) - 1
+    idx = np.searchsorted(bounds, values, side="right") - 1
+    idx = np.where((idx < 0) | (idx >= sentinel), sentinel, idx)
+    return coefs[idx]
+
+
+def _pad_nan_row(coefs: np.ndarray) -> np.ndarray:
+    return np.vstack([coefs, np.full(coefs.shape[1], np.nan)])
 
 
-def _normalize_star_colors(stars: List[OutputStarInfo]) -> List[OutputStarInfo]:
-    # inner function
-    def _normalize_star_color(star: OutputStarInfo, rgb_max: float) -> OutputStarInfo:
-        oc = star.c
-        star.c = (oc[0] / rgb_max, oc[1] / rgb_max, oc[2] / rgb_max)
-        return star
+#
+# PRECOMPUTED TABLES
+# ------------------------------------------------------------------------------
+
+# T(K) to xy coefficients, padded with the NaN sentinel row for out of range
+_T_CX_COEFS_PADDED = _pad_nan_row(T_CX_COEFS)
+_T_CY_COEFS_PADDED = _pad_nan_row(T_CY_COEFS)
+
+# b-v -> linear rgb table, indexed by the rounded b-v value
+_BV_LUT_STEP = (BV_LUT_RANGE[1] - BV_LUT_RANGE[0]) / (BV_LUT_SIZE - 1)
+_BV_LUT = _convert_bv_to_linear_rgb_batch(np.linspace(*BV_LUT_RANGE, BV_LUT_SIZE))
+
+
+#
+# LOGGING
+# ------------------------------------------------------------------------------
+
 
-    # apply for star list
-    rgb_max = max([max(s.c) for s in stars])
-    return [_normalize_star_color(s, rgb_max) for s in stars]
+def _setup_logging():
+    basicConfig(filename=LOG_FILE, level=DEBUG)
 
 
-TCOEF = TypeVar("TCOEF")
+def _setup_worker_logging(queue: multiprocessing.Queue, level: int):
+    # replace handlers inherited by fork, all records go to the parent process.
+    root = getLogger()
+    root.handlers = [QueueHandler(queue)]
+    root.setLevel(level)
 
 
-def _select_coef_table(
-    value: float,
-    coef_table: list[tuple[float, float, TCOEF]],
-) -> Optional[TCOEF]:
-    for (low, high, coef) in coef_table:
-        if low <= value < high:
-            return coef
-    return None
+class _RelayHandler(Handler):
+    # handles records from the worker processes by the loggers of this process.
+    def emit(self, record: LogRecord):
+        getLogger(record.name).handle(record)
 
 
 #
@@ -469,5 +784,5 @@ def _select_coef_table(
 
 # global entry point
 if __name__ == "__main__":
-    basicConfig(filename="convert.log", level=DEBUG)
+    _setup_logging()
     _main()
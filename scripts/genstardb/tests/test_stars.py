@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.stars import HP_DEC_LAYOUT, HP_RA_LAYOUT, _read_sexagesimal
+
+
+def _read(items: list[str], layout: str) -> list[float]:
+    return _read_sexagesimal(pd.Series(items), layout).tolist()
+
+
+def test_read_ra():
+    assert _read(["00 00 00.00", "12 34 56.78"], HP_RA_LAYOUT) == [
+        0.0,
+        12 * 3600 + 34 * 60 + 56.78,
+    ]
+
+
+@pytest.mark.parametrize(
+    "item, expected",
+    [
+        ("+00 30 00.0", 1800.0),
+        ("-00 30 00.0", -1800.0),
+        ("-00 00 00.5", -0.5),
+        ("-12 34 56.7", -(12 * 3600 + 34 * 60 + 56.7)),
+    ],
+)
+def test_read_dec_sign(item: str, expected: float):
+    assert _read([item], HP_DEC_LAYOUT) == [expected]
+
+
+@pytest.mark.parametrize(
+    "item, layout",
+    [
+        # blank
+        ("", HP_RA_LAYOUT),
+        ("           ", HP_RA_LAYOUT),
+        ("           ", HP_DEC_LAYOUT),
+        # wrong width, items are not padded nor trimmed
+        ("0 0 0.22", HP_RA_LAYOUT),
+        ("00 00 00.2", HP_RA_LAYOUT),
+        ("00 00 00.223", HP_RA_LAYOUT),
+        (" 00 00 00.22", HP_RA_LAYOUT),
+        ("00 30 00.0", HP_DEC_LAYOUT),
+        # non-digit characters
+        ("0a 00 00.00", HP_RA_LAYOUT),
+        ("00 00 0-.00", HP_RA_LAYOUT),
+        ("+00 00 00. ", HP_DEC_LAYOUT),
+        # wrong separators or sign
+        ("00:00:00.00", HP_RA_LAYOUT),
+        ("00 00 00,00", HP_RA_LAYOUT),
+        (" 00 30 00.0", HP_DEC_LAYOUT),
+        ("x00 30 00.0", HP_DEC_LAYOUT),
+    ],
+)
+def test_read_malformed(item: str, layout: str):
+    assert np.isnan(_read([item], layout)).all()
+
+
+def test_read_malformed_among_valid():
+    values = _read(["01 00 00.00", "1 0 0.00", "02 00 00.00"], HP_RA_LAYOUT)
+    assert values[0] == 3600.0
+    assert np.isnan(values[1])
+    assert values[2] == 7200.0
+
+
+def test_read_fraction_same_as_float():
+    # every SS.FF should be the same value as parsing it by float()
+    seconds = [f"{s // 100:02d}.{s % 100:02d}" for s in range(6000)]
+    values = _read([f"23 59 {s}" for s in seconds], HP_RA_LAYOUT)
+    assert values == [23 * 3600 + 59 * 60 + float(s) for s in seconds]
+    values = _read([f"00 00 {s}" for s in seconds], HP_RA_LAYOUT)
+    assert values == [float(s) for s in seconds]
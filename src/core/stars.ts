@@ -44,6 +44,11 @@ export interface StarMetadata {
   files: [number, number, string][];
   /** unix epoch for proper motion */
   epoch: number;
+  /**
+   * star colors (linear rgb) referred by index, since format version 2.
+   * - undefined: each star has its color.
+   */
+  palette?: [number, number, number][];
 }
 
 /**
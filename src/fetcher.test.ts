@@ -1,6 +1,12 @@
 import { toBeDeepCloseTo, toMatchCloseTo } from "jest-matcher-deep-close-to";
 import { StarMetadata } from "./core";
-import { getRequiredStarsFiles } from "./fetcher";
+import {
+  getRequiredStarsFiles,
+  parseMetadata,
+  parseStar,
+  RawStar,
+  RawStarMetadata,
+} from "./fetcher";
 expect.extend({ toBeDeepCloseTo, toMatchCloseTo });
 
 describe("resolve required star file range", () => {
@@ -39,3 +45,71 @@ describe("resolve required star file range", () => {
     ]);
   });
 });
+
+describe("parse stars", () => {
+  const rawMeta: RawStarMetadata = {
+    v_map_range: [-1.0, 15.0],
+    files: [[-1.0, 15.0, "stars_0.json"]],
+    pm_epoch: 100,
+  };
+  const palette: [number, number, number][] = [
+    [0.25, 0.5, 0.75],
+    [1.0, 0.5, 0.0],
+  ];
+  const rawStar = (c: RawStar["c"]): RawStar => ({
+    n: 42,
+    p: [90.0, -45.0, 10.0],
+    m: [3600000.0, -3600000.0],
+    v: 5.5,
+    c: c,
+  });
+  const expected = {
+    id: 42,
+    ra: Math.PI / 2,
+    dec: -Math.PI / 4,
+    parallax: 10.0,
+    epoch: 100,
+    pmRa: Math.PI / 180,
+    pmDec: -Math.PI / 180,
+    vMag: 5.5,
+  };
+  test("parse version 1 metadata without the palette", () => {
+    const meta = parseMetadata(rawMeta, "src");
+    expect(meta.palette).toBeUndefined();
+    expect(meta.epoch).toBe(100);
+  });
+  test("parse version 2 metadata with the palette", () => {
+    const meta = parseMetadata({ ...rawMeta, palette, version: 2 }, "src");
+    expect(meta.palette).toStrictEqual(palette);
+  });
+  test("reject version 2 metadata without the palette", () => {
+    expect(() => parseMetadata({ ...rawMeta, version: 2 }, "src")).toThrow();
+  });
+  test("reject unsupported version of metadata", () => {
+    expect(() =>
+      parseMetadata({ ...rawMeta, palette, version: 3 }, "src")
+    ).toThrow();
+  });
+  test("parse version 1 star with rgb color", () => {
+    expect(parseStar(rawStar([0.1, 0.2, 0.3]), 100)).toBeDeepCloseTo({
+      ...expected,
+      r: 0.1,
+      g: 0.2,
+      b: 0.3,
+    });
+  });
+  test("parse version 2 star with palette index", () => {
+    expect(parseStar(rawStar(1), 100, palette)).toBeDeepCloseTo({
+      ...expected,
+      r: 1.0,
+      g: 0.5,
+      b: 0.0,
+    });
+  });
+  test("reject palette index without the palette", () => {
+    expect(() => parseStar(rawStar(1), 100)).toThrow(/#42/);
+  });
+  test("reject palette index out of the palette", () => {
+    expect(() => parseStar(rawStar(2), 100, palette)).toThrow(/#42/);
+  });
+});
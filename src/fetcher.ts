@@ -141,18 +141,42 @@ const checkResponse = (r: Response) => {
   );
 };
 
-interface RawStarMetadata {
+/**
+ * Latest version of the star data format this fetcher can read.
+ */
+export const SUPPORTED_STAR_DATA_VERSION = 2;
+
+export interface RawStarMetadata {
   v_map_range: [number, number];
   files: [number, number, string][];
   pm_epoch: number;
+  // star colors, linear rgb [0..1], since version 2
+  palette?: [number, number, number][];
+  // format version, absent in version 1
+  version?: number;
 }
 
-const parseMetadata = (obj: RawStarMetadata, source: string): StarMetadata => ({
-  source: source,
-  vRange: obj.v_map_range,
-  files: obj.files,
-  epoch: obj.pm_epoch,
-});
+export const parseMetadata = (
+  obj: RawStarMetadata,
+  source: string
+): StarMetadata => {
+  const version = obj.version ?? 1;
+  if (version > SUPPORTED_STAR_DATA_VERSION) {
+    throw new Error(
+      "unsupported star data version " + version + " from " + source
+    );
+  }
+  if (version >= 2 && !Array.isArray(obj.palette)) {
+    throw new Error("star data version " + version + " requires the palette");
+  }
+  return {
+    source: source,
+    vRange: obj.v_map_range,
+    files: obj.files,
+    epoch: obj.pm_epoch,
+    palette: obj.palette,
+  };
+};
 
 const fetchMetadata = (url: string) =>
   fetch(url)
@@ -161,7 +185,7 @@ const fetchMetadata = (url: string) =>
     .then((m) => m as RawStarMetadata)
     .then((m) => parseMetadata(m, url));
 
-interface RawStar {
+export interface RawStar {
   // star number
   n: number;
   // position (right ascention, declination, and parallax)
@@ -170,33 +194,45 @@ interface RawStar {
   m: [number, number];
   // magnitude of Johnson V
   v: number;
-  // star color, linear rgb [0..1]
-  c: [number, number, number];
+  // star color, linear rgb [0..1], or index of the palette (version 2)
+  c: [number, number, number] | number;
 }
 
 // conversion factor for millarcseconds to degrees.
 const MAS_TO_DEG = 1 / 3600000;
 
-const parseStar = (obj: RawStar, epoch: number): Star => ({
-  id: obj.n,
-  ra: degToRad(obj.p[0]),
-  dec: degToRad(obj.p[1]),
-  parallax: obj.p[2],
-  epoch: epoch,
-  pmRa: degToRad(obj.m[0] * MAS_TO_DEG),
-  pmDec: degToRad(obj.m[1] * MAS_TO_DEG),
-  vMag: obj.v,
-  r: obj.c[0],
-  g: obj.c[1],
-  b: obj.c[2],
-});
+export const parseStar = (
+  obj: RawStar,
+  epoch: number,
+  palette?: [number, number, number][]
+): Star => {
+  const c = typeof obj.c === "number" ? palette?.[obj.c] : obj.c;
+  if (!c) {
+    throw new Error("star #" + obj.n + " refers missing color " + obj.c);
+  }
+  return {
+    id: obj.n,
+    ra: degToRad(obj.p[0]),
+    dec: degToRad(obj.p[1]),
+    parallax: obj.p[2],
+    epoch: epoch,
+    pmRa: degToRad(obj.m[0] * MAS_TO_DEG),
+    pmDec: degToRad(obj.m[1] * MAS_TO_DEG),
+    vMag: obj.v,
+    r: c[0],
+    g: c[1],
+    b: c[2],
+  };
+};
 
 const fetchStar = async (metadata: StarMetadata, file: string) => {
   const meta_host = metadata.source.slice(0, metadata.source.lastIndexOf("/"));
   return fetch(meta_host + "/" + file)
     .then(checkResponse)
     .then((r) => r.json())
-    .then((s: any[]) => s.map((o) => parseStar(o, metadata.epoch)))
+    .then((s: any[]) =>
+      s.map((o) => parseStar(o, metadata.epoch, metadata.palette))
+    )
     .then((s) =>
       s.reduce<StarDict>((d, s) => {
         d[s.id] = s;